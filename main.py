@@ -1,34 +1,152 @@
-from fastapi import FastAPI, HTTPException, Path, Body
-from pydantic import BaseModel, Field, field_validator
+from fastapi import FastAPI, HTTPException, Path, Body, Response
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field, field_validator, model_validator
 from datetime import date
 from babel import Locale
-import pandas as pd
-import numpy as np
+from collections import Counter
+from contextlib import asynccontextmanager
+import asyncio
+import logging
+import orjson
 import uvicorn
 import calendar
+import csv
+import os
+import re
 import webbrowser
 
-app = FastAPI(title="Outgoing correspondence: sent by Thomas Mann.")
-
-# Dataset laden + "clean"
-df = pd.read_csv("outgoing.csv", sep=";", encoding="utf-8", na_values=[""])
-df.replace({np.nan: "Daten fehlen"}, inplace=True)
+logger = logging.getLogger(__name__)
+
+# Startet den Hintergrund-Flush beim Hochfahren und schreibt offene Änderungen beim Herunterfahren
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    flush_task = asyncio.create_task(flush_loop())
+    yield
+    flush_task.cancel()
+    try:
+        await flush_task
+    except asyncio.CancelledError:
+        pass
+    flush_if_dirty()
+
+app = FastAPI(title="Outgoing correspondence: sent by Thomas Mann.", lifespan=lifespan)
+
+CSV_PATH = "outgoing.csv"
+FIELDNAMES = ("Signatur", "Titel", "Form und Inhalt", "Entstehungszeitraum", "Bemerkungen zur Datierung", "Bemerkungen zum Umfang", "Sprachen", "ID")
+MODEL_ATTRS = ("reference_code", "title", "scope_and_content", "date", "notes_on_date", "extent", "language", "id") # Modellattribute in FIELDNAMES-Reihenfolge
+
+# Dataset laden + "clean"; eine Liste von Dicts reicht für diesen CRUD-Workload, pandas wird nicht gebraucht
+rows: list[dict] = []
+with open(CSV_PATH, encoding="utf-8", newline="") as f:
+    for row in csv.DictReader(f, delimiter=";"):
+        for key, value in row.items():
+            if not value:
+                row[key] = "Daten fehlen"
+        row["ID"] = int(row["ID"])
+        rows.append(row)
+
+# Indexe für O(1)-Lookups statt O(N)-Scans über die Liste
+id_index = {row["ID"]: i for i, row in enumerate(rows)} # ID -> Listenposition
+# Multiset statt Set: die Ausgangsdaten enthalten Signaturen, die auf zwei Zeilen vorkommen,
+# ein Set würde beim Löschen einer der beiden Zeilen die Signatur komplett freigeben
+sig_counter = Counter(row["Signatur"] for row in rows)
+
+# Entfernt ein Vorkommen einer Signatur aus dem Multiset
+def release_sig(sig: str):
+    sig_counter[sig] -= 1
+    if sig_counter[sig] <= 0:
+        del sig_counter[sig]
+
+# Fertig serialisierte Antwort für /all-correspondences; None = muss neu aufgebaut werden
+all_json_cache: bytes | None = None
+data_version = 0 # zählt Mutationen, damit ein laufender Stream keinen veralteten Cache schreibt
+
+# Verwirft die gecachte Antwort nach jeder Mutation
+def invalidate_all_cache():
+    global all_json_cache, data_version
+    all_json_cache = None
+    data_version += 1
+
+# Schreibt den gesamten Datenbestand zurück in die CSV-Datei (atomar via Umbenennen)
+def save_rows():
+    tmp_path = CSV_PATH + ".tmp"
+
+    with open(tmp_path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDNAMES, delimiter=";", lineterminator="\n")
+        writer.writeheader()
+        writer.writerows(rows)
+
+    os.replace(tmp_path, CSV_PATH) # bei einem Absturz bleibt die alte Datei vollständig erhalten
+
+# Serialisiert POST/PUT/DELETE: ohne Lock könnten zwei gleichzeitige Requests beide
+# "ID existiert nicht" sehen und dieselbe ID doppelt einfügen
+mutation_lock = asyncio.Lock()
+
+FLUSH_INTERVAL = 1.0 # Sekunden zwischen zwei Hintergrund-Flushes
+dirty = False # True, sobald rows neuer ist als die CSV-Datei
+
+# Merkt eine Mutation zum nächsten Hintergrund-Flush vor
+def mark_dirty():
+    global dirty
+    dirty = True
+
+# Schreibt offene Änderungen auf die Platte
+def flush_if_dirty():
+    global dirty
+    if dirty:
+        save_rows()
+        dirty = False
+
+# Hintergrund-Task: amortisiert das O(N)-Schreiben über viele Mutationen
+async def flush_loop():
+    while True:
+        await asyncio.sleep(FLUSH_INTERVAL)
+
+        # Ein fehlgeschlagener Flush darf den Task nicht beenden, sonst wird nie wieder gespeichert;
+        # dirty bleibt gesetzt, der nächste Durchlauf versucht es erneut
+        try:
+            flush_if_dirty()
+        except Exception:
+            logger.exception("CSV-Flush fehlgeschlagen, nächster Versuch in %s Sekunden.", FLUSH_INTERVAL)
 
 # Muster
-reference_code_pattern = r"^B-I-[A-Z]+-\d+(\.\d+)?$" # Erlaubt: "B-I-GROßBUCHSTABEN-ZAHL(.ZAHL)", z. B. "B-I-ALBER-3" oder "B-I-ALBER-3.1"
-date_pattern = r"^(ca\.\s*)?(\d{2}\.\d{2}\.\d{4}|\d{2}\.\d{4}|\d{4})$" # Erlaubt: "ca. DD.MM.YYYY", "DD.MM.YYYY", "ca. MM.YYYY", "MM.YYYY", "ca. YYYY", "YYYY"
+# Signatur und Datum werden ohne Regex geprüft, siehe valid_reference_code bzw. check_date_possible
 extent_pattern = r"^(\d+\sBl\./\d+\sS\.)(\s\+\s\d+\sBl\./\d+\sS\.)*$" # Erlaubt: ZAHL Bl./ZAHL S.( + ZAHL Bl./ZAHL S.)
 
+# Einmalig kompiliert (re.ASCII, da das Muster reine ASCII-Eingaben prüft), statt pattern= im Field
+extent_re = re.compile(extent_pattern, re.ASCII)
+
+# Prüft "B-I-GROSSBUCHSTABEN-ZAHL(.ZAHL)" mit reinen Stringmethoden statt Regex-Engine
+def valid_reference_code(v: str) -> bool:
+    if not v.startswith("B-I-") or not v.isascii():
+        return False
+
+    try:
+        letters, number = v[4:].rsplit("-", 1)
+    except ValueError: # kein weiterer Bindestrich
+        return False
+
+    if not letters or not letters.isalpha() or not letters.isupper():
+        return False
+
+    if "." in number:
+        whole, fraction = number.split(".", 1)
+        return whole.isdigit() and fraction.isdigit()
+
+    return number.isdigit()
+
 # Thomas Manns Lebensdauer
 birth_date = date(1875, 6, 6)
 death_date = date(1955, 8, 12)
 
+# Deutsche Sprachnamen (klein geschrieben), einmalig beim Import aus den CLDR-Daten geladen
+GERMAN_LANGS_LOWER = frozenset(name.lower() for name in Locale("de").languages.values())
+
 # Korrespondenz-Klasse
 class Correspondence(BaseModel):
     reference_code: str = Field(
         ..., 
         description="Must be in the format B-I-UPPERCASE-NUMBERS(.NUMBERS), e.g. 'B-I-ALBER-3' or 'B-I-ALBER-3.1'.",
-        pattern=reference_code_pattern,
         alias="Signatur"
     )
     title: str = Field(..., alias="Titel")
@@ -36,14 +154,12 @@ class Correspondence(BaseModel):
     date: str = Field(
         ..., 
         description="Must be in the format 'ca. DD.MM.YYYY', 'DD.MM.YYYY', 'ca. MM.YYYY', 'MM.YYYY', 'ca. YYYY', 'YYYY'.",
-        pattern=date_pattern,
         alias="Entstehungszeitraum"
     )
     notes_on_date: str = Field(..., alias="Bemerkungen zur Datierung")
     extent: str = Field(
         ..., 
         description="Must be in the format NUMBER Bl./NUMBER S.( + NUMBER Bl./NUMBER S.).",
-        pattern=extent_pattern,
         alias="Bemerkungen zum Umfang"
     )
     language: str = Field(..., alias="Sprachen")
@@ -70,20 +186,47 @@ class Correspondence(BaseModel):
         } # Bsp. für den Request Body im Swagger UI
     }
 
-    # Prüft, ob Datum sinnvoll ist
+    # Prüft das Signatur-Format
+    @field_validator("reference_code")
+    @classmethod
+    def check_reference_code_format(cls, v: str):
+        if not valid_reference_code(v):
+            raise ValueError(f"Signatur '{v}' entspricht nicht dem Muster B-I-GROSSBUCHSTABEN-ZAHL(.ZAHL).")
+
+        return v
+
+    # Prüft das Umfangs-Format
+    @field_validator("extent")
+    @classmethod
+    def check_extent_format(cls, v: str):
+        if not extent_re.match(v):
+            raise ValueError(f"Umfang '{v}' entspricht nicht dem Muster ZAHL Bl./ZAHL S.( + ZAHL Bl./ZAHL S.).")
+
+        return v
+
+    # Prüft Format und Plausibilität des Datums in einem Durchlauf (ohne Regex)
     @field_validator("date")
     @classmethod
     def check_date_possible(cls, v: str):
-        processed_date_str = v.replace("ca. ", "").strip()
+        processed_date_str = v[4:] if v.startswith("ca. ") else v
         parts = processed_date_str.split(".")
 
+        # Formatprüfung: DD.MM.YYYY, MM.YYYY oder YYYY, alle Teile rein numerisch
+        expected_lengths = {3: (2, 2, 4), 2: (2, 4), 1: (4,)}.get(len(parts))
+        if expected_lengths is None or any(
+            len(part) != length or not part.isdigit()
+            for part, length in zip(parts, expected_lengths)
+        ):
+            raise ValueError(f"Datum '{v}' entspricht keinem der erlaubten Formate (ca. DD.MM.YYYY, DD.MM.YYYY, ca. MM.YYYY, MM.YYYY, ca. YYYY, YYYY).")
+
         try:
             if len(parts) == 3: # DD.MM.YYYY
                 d, m, y = map(int, parts)
                 start_date = end_date = date(y, m, d)
             elif len(parts) == 2: # MM.YYYY
                 m, y = map(int, parts)
-                start_date = date(y, m, calendar.monthrange(y, m)[1])
+                start_date = date(y, m, 1)
+                end_date = date(y, m, calendar.monthrange(y, m)[1])
             else: # YYYY
                 y = int(parts[0])
                 start_date = date(y, 1, 1)
@@ -99,129 +242,148 @@ class Correspondence(BaseModel):
         
         return v
     
-    @staticmethod
-    def get_german_language_names():
-        locale = Locale("de")
+    # Ersetzt leere Freitextfelder durch den Platzhalter, einmal pro Request statt per Schleife im Handler
+    @model_validator(mode="after")
+    def blank_to_placeholder(self):
+        for field in ("title", "scope_and_content", "notes_on_date"):
+            value = getattr(self, field).strip()
+            setattr(self, field, value or "Daten fehlen")
+
+        return self
 
-        return locale.languages # dict: {"en": "Englisch", "de": "Deutsch", ...}
-    
     # Prüft, ob Sprache sinnvoll ist
     @field_validator("language")
     @classmethod
     def check_language_possible(cls, v: str):
         language_stripped = v.strip()
-        german_names = cls.get_german_language_names()
-        german_names_lower = {name.lower() for name in german_names.values()}
 
-        if language_stripped.lower() not in german_names_lower:
+        if language_stripped.lower() not in GERMAN_LANGS_LOWER:
             raise ValueError(f"Die Sprache '{v}' ist keine bekannte Sprache auf Deutsch.")
         
         return language_stripped
 
-# Liefert alle Einträge als JSON-Liste
+# Baut aus einem validierten Modell die Zeile in Spaltenreihenfolge
+def entry_from_model(correspondence: Correspondence) -> dict:
+    return dict(zip(FIELDNAMES, (getattr(correspondence, attr) for attr in MODEL_ATTRS)))
+
+# Liefert alle Einträge als JSON-Liste; gestreamt, damit die Antwort nie komplett im Speicher aufgebaut wird
 @app.get("/all-correspondences")
 async def get_all_correspondences():
-    entry = df.to_dict(orient="records")
+    if all_json_cache is not None:
+        return Response(content=all_json_cache, media_type="application/json")
+
+    # Serialisiert zeilenweise und befüllt dabei den Cache für spätere Reads
+    async def stream():
+        global all_json_cache
+        version = data_version
+        parts = [b'{"message":' + orjson.dumps("Einträge wurden erfolgreich abgerufen.") + b',"correspondence":[']
+
+        yield parts[0]
+
+        for i, row in enumerate(rows):
+            chunk = (b"," if i else b"") + orjson.dumps(row)
+            parts.append(chunk)
+            yield chunk
 
-    return {"message": f"Einträge wurden erfolgreich abgerufen.", "correspondence": entry}
+        parts.append(b"]}")
+        yield b"]}"
+
+        if version == data_version: # keine Mutation während des Streams
+            all_json_cache = b"".join(parts)
+
+    return StreamingResponse(stream(), media_type="application/json")
 
 # Liefert einen Eintrag als JSON
 @app.get("/correspondence/{id}")
 async def get_one_correspondence(id: int = Path(..., ge=0)):
-    row = df.loc[df["ID"] == id]
-    
-    if row.empty:
+    if id not in id_index:
         raise HTTPException(status_code=404, detail=f"Eintrag mit ID {id} nicht gefunden.")
-    
-    entry = row.iloc[0].to_dict()
+
+    entry = rows[id_index[id]]
 
     return {"message": f"Eintrag mit ID {id} wurde erfolgreich abgerufen.", "correspondence": entry}
 
-# Postet einen Eintrag als DataFrame-Zeile
+# Postet einen Eintrag als neue Zeile
 @app.post("/correspondence", status_code=201)
 async def add_correspondence(correspondence: Correspondence):
-    global df
+    async with mutation_lock:
+        # ID einmalig?
+        if correspondence.id in id_index:
+            raise HTTPException(status_code=400, detail=f"ID '{correspondence.id}' existiert bereits.")
 
-    # ID einmalig?
-    if correspondence.id in df["ID"].values:
-        raise HTTPException(status_code=400, detail=f"ID '{correspondence.id}' existiert bereits.")
-    
-    # Signatur einmalig?
-    if correspondence.reference_code in df["Signatur"].values:
-        raise HTTPException(status_code=400, detail=f"Signatur '{correspondence.reference_code}' existiert bereits.")
-
-    new_entry = {
-        "Signatur": correspondence.reference_code,
-        "Titel": correspondence.title,
-        "Form und Inhalt": correspondence.scope_and_content,
-        "Entstehungszeitraum": correspondence.date,
-        "Bemerkungen zur Datierung": correspondence.notes_on_date,
-        "Bemerkungen zum Umfang": correspondence.extent,
-        "Sprachen": correspondence.language,
-        "ID": correspondence.id
-    }
+        # Signatur einmalig?
+        if sig_counter[correspondence.reference_code] > 0:
+            raise HTTPException(status_code=400, detail=f"Signatur '{correspondence.reference_code}' existiert bereits.")
 
-    for key, value in new_entry.items():
-        if isinstance(value, str):
-            new_entry[key] = value.strip() or "Daten fehlen"
+        new_entry = entry_from_model(correspondence)
 
-    df = pd.concat([df, pd.DataFrame([new_entry])], ignore_index=True)
-    df.to_csv("outgoing.csv", sep=";", index=False, encoding="utf-8") # Eintrag wird in Datei gespeichert
+        rows.append(new_entry)
+        id_index[correspondence.id] = len(rows) - 1
+        sig_counter[new_entry["Signatur"]] += 1
+        invalidate_all_cache()
+        mark_dirty()
 
-    return {"message": "Eintrag wurde erfolgreich hinzugefügt.", "correspondence": new_entry}
+        return {"message": "Eintrag wurde erfolgreich hinzugefügt.", "correspondence": new_entry}
 
 # Löscht einen Eintrag
 @app.delete("/correspondence/{id}", status_code=200)
 async def delete_correspondence(id: int = Path(..., ge=0)):
-    global df
-    row_index = df.index[df["ID"] == id].tolist()
+    async with mutation_lock:
+        if id not in id_index:
+            raise HTTPException(status_code=404, detail=f"Eintrag mit ID {id} nicht gefunden.")
 
-    if not row_index:
-        raise HTTPException(status_code=404, detail=f"Eintrag mit ID {id} nicht gefunden.")
+        row_index = id_index.pop(id)
+        removed = rows.pop(row_index)
+        release_sig(removed["Signatur"])
 
-    df = df.drop(index=row_index[0]).reset_index(drop=True)
-    df.to_csv("outgoing.csv", sep=";", index=False, encoding="utf-8")
+        # Alle nachfolgenden Zeilen rutschen um eine Position nach oben
+        for i in range(row_index, len(rows)):
+            id_index[rows[i]["ID"]] = i
 
-    return {"message": f"Eintrag mit ID {id} wurde erfolgreich gelöscht.", "deleted_id": id}
+        invalidate_all_cache()
+        mark_dirty()
+
+        return {"message": f"Eintrag mit ID {id} wurde erfolgreich gelöscht.", "deleted_id": id}
 
 # Updatet einen Eintrag
 @app.put("/correspondence/{id}", status_code=200)
 async def replace_correspondence(id: int = Path(..., ge=0), correspondence: Correspondence = Body(...)):
-    # Pfad-ID == Body-ID?
-    if correspondence.id != id:
-        raise HTTPException(status_code=400, detail=f"Body-ID {correspondence.id} muss mit Pfad-ID {id} übereinstimmen.")
+    async with mutation_lock:
+        # Pfad-ID == Body-ID?
+        if correspondence.id != id:
+            raise HTTPException(status_code=400, detail=f"Body-ID {correspondence.id} muss mit Pfad-ID {id} übereinstimmen.")
 
-    # Existiert ID?
-    index = df.index[df["ID"] == id].tolist()
-    if not index:
-        raise HTTPException(status_code=404, detail=f"Eintrag mit ID {id} nicht gefunden.")
-    row_index = index[0]
-
-    # Signatur einmalig?
-    existing_sigs = set(df.loc[df.index != row_index, "Signatur"].tolist())
-    if correspondence.reference_code in existing_sigs:
-        raise HTTPException(status_code=400, detail=f"Signatur '{correspondence.reference_code}' existiert bereits.")
-
-    new_entry = {
-        "Signatur": correspondence.reference_code,
-        "Titel": correspondence.title,
-        "Form und Inhalt": correspondence.scope_and_content,
-        "Entstehungszeitraum": correspondence.date,
-        "Bemerkungen zur Datierung": correspondence.notes_on_date or "Daten fehlen",
-        "Bemerkungen zum Umfang": correspondence.extent,
-        "Sprachen": correspondence.language,
-        "ID": correspondence.id
-    }
+        # Existiert ID?
+        if id not in id_index:
+            raise HTTPException(status_code=404, detail=f"Eintrag mit ID {id} nicht gefunden.")
+        row_index = id_index[id]
+
+        # Signatur einmalig?
+        old_sig = rows[row_index]["Signatur"]
+        if sig_counter[correspondence.reference_code] > 0 and correspondence.reference_code != old_sig:
+            raise HTTPException(status_code=400, detail=f"Signatur '{correspondence.reference_code}' existiert bereits.")
+
+        new_entry = entry_from_model(correspondence)
+
+        rows[row_index] = new_entry
 
-    for col, val in new_entry.items():
-        df.at[row_index, col] = val
+        if new_entry["Signatur"] != old_sig:
+            release_sig(old_sig)
+            sig_counter[new_entry["Signatur"]] += 1
 
-    df.to_csv("outgoing.csv", sep=";", index=False, encoding="utf-8")
+        invalidate_all_cache()
+        mark_dirty()
 
-    return {"message": f"Eintrag mit ID {id} wurde erfolgreich aktualisiert.", "correspondence": new_entry}
+        return {"message": f"Eintrag mit ID {id} wurde erfolgreich aktualisiert.", "correspondence": new_entry}
 
-# Startet Uvicorn-Server
+# Startet Uvicorn-Server; Browser nur mit OPEN_BROWSER=1, Auto-Reload nur im Entwicklungsmodus (DEV=1)
 if __name__ == "__main__":
-    url = "http://127.0.0.1:5000/docs"
-    webbrowser.open(url)
-    uvicorn.run("main:app", host="127.0.0.1", port=5000, reload=True, log_level="info")
\ No newline at end of file
+    if os.environ.get("OPEN_BROWSER") == "1":
+        url = "http://127.0.0.1:5000/docs"
+        webbrowser.open(url)
+
+    if os.environ.get("DEV") == "1":
+        uvicorn.run("main:app", host="127.0.0.1", port=5000, reload=True, log_level="info")
+    else:
+        # uvloop/httptools statt asyncio/h11, Access-Log aus: weniger Overhead pro Request
+        uvicorn.run("main:app", host="127.0.0.1", port=5000, loop="uvloop", http="httptools", access_log=False, log_level="warning")
\ No newline at end of file